@@ -5,25 +5,40 @@ Enhanced version with AI-powered dynamic responses and speech-to-text
 """
 
 import asyncio
+import functools
+import itertools
+import hashlib
+import io
 import logging
-import sqlite3
-import json
+import re
 import time
 import os
+import random
 import tempfile
 import subprocess
-import requests
+import httpx
+import aiosqlite
+import orjson
+from collections import OrderedDict
 from datetime import datetime, timedelta
-from typing import Dict, List, Optional
+from typing import AsyncIterable, Dict, List, Optional, Union
 from dotenv import load_dotenv
 
 from telethon import TelegramClient, events
 from telethon.tl.types import User, Chat, Channel, DocumentAttributeAudio
-from openai import AzureOpenAI
+from openai import AsyncAzureOpenAI, APIConnectionError, InternalServerError, RateLimitError
+from aiolimiter import AsyncLimiter
+
+try:
+    import uvloop
+except ImportError:  # uvloop is not available on Windows
+    uvloop = None
 
 # Load environment variables
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 # =================== CONFIGURATION ===================
 class Config:
     # Telegram API credentials
@@ -38,7 +53,13 @@ class Config:
     AZURE_ENDPOINT = os.getenv("AZURE_OPENAI_ENDPOINT")
     AZURE_API_KEY = os.getenv("AZURE_OPENAI_API_KEY")
     AZURE_API_VERSION = os.getenv("AZURE_API_VERSION", "2024-12-01-preview")
-    AZURE_DEPLOYMENT = os.getenv("AZURE_GPT_DEPLOYMENT", "gpt-4o")
+    # Comma-separated; requests are spread round-robin across deployments
+    AZURE_DEPLOYMENTS = [d.strip() for d in os.getenv("AZURE_GPT_DEPLOYMENT", "gpt-4o").split(",") if d.strip()]
+    
+    # Client-side limits for Azure OpenAI requests
+    AZURE_MAX_CONCURRENCY = int(os.getenv("AZURE_MAX_CONCURRENCY", "10"))
+    AZURE_MAX_RPM = int(os.getenv("AZURE_MAX_RPM", "300"))
+    AZURE_MAX_RETRIES = int(os.getenv("AZURE_MAX_RETRIES", "3"))
     
     # Speech-to-Text Configuration
     AZURE_WHISPER_DEPLOYMENT = os.getenv("AZURE_WHISPER_DEPLOYMENT", "whisper")
@@ -50,7 +71,20 @@ class Config:
     # Bot behavior
     RESPONSE_DELAY = int(os.getenv("RESPONSE_DELAY", "2"))
     MAX_HISTORY_LENGTH = int(os.getenv("MAX_HISTORY_LENGTH", "8"))
+    PROMPT_HISTORY_LENGTH = int(os.getenv("PROMPT_HISTORY_LENGTH", "4"))  # Entries sent to the LLM, keep it even
     MAX_RESPONSE_TOKENS = int(os.getenv("MAX_RESPONSE_TOKENS", "150"))
+    STREAM_RESPONSES = os.getenv("STREAM_RESPONSES", "true").lower() == "true"
+    RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", "86400"))  # Seconds, 0 disables
+    
+    # Parallel media part downloads
+    DOWNLOAD_CONCURRENCY = int(os.getenv("DOWNLOAD_CONCURRENCY", "4"))
+    
+    # ffmpeg conversions run at once; each one is a CPU-bound process
+    FFMPEG_CONCURRENCY = int(os.getenv("FFMPEG_CONCURRENCY", str(os.cpu_count() or 2)))
+    
+    # Micro-batching of chat completions (LLM_BATCH_SIZE=1 disables it)
+    LLM_BATCH_SIZE = int(os.getenv("LLM_BATCH_SIZE", "1"))
+    LLM_BATCH_WINDOW = int(os.getenv("LLM_BATCH_WINDOW_MS", "50")) / 1000
     
     # Auto-response settings
     AUTO_RESPOND = os.getenv("AUTO_RESPOND", "true").lower() == "true"
@@ -79,43 +113,75 @@ class Config:
             raise ValueError(f"Missing required environment variables: {', '.join(missing_vars)}")
 
 # =================== AUDIO CONVERTER ===================
+@functools.lru_cache(maxsize=1)
+def ffmpeg_available() -> bool:
+    """Check if ffmpeg is available (probed once per process)"""
+    try:
+        subprocess.run(['ffmpeg', '-version'], capture_output=True, check=True)
+        return True
+    except (subprocess.CalledProcessError, FileNotFoundError):
+        return False
+
 class AudioConverter:
     @staticmethod
-    def check_ffmpeg():
-        """Check if ffmpeg is available"""
-        try:
-            subprocess.run(['ffmpeg', '-version'], capture_output=True, check=True)
-            return True
-        except (subprocess.CalledProcessError, FileNotFoundError):
-            return False
-    
-    @staticmethod
-    def convert_to_wav(input_file: str, output_file: str) -> bool:
-        """Convert audio file to WAV format using ffmpeg"""
+    async def convert_to_wav(audio: Union[bytes, AsyncIterable[bytes]]) -> Optional[bytes]:
+        """Convert audio to WAV format using ffmpeg, piping through stdin/stdout
+        
+        `audio` may also be an async iterable of chunks, which are fed to ffmpeg
+        as they arrive so decoding overlaps the download.
+        """
         try:
             cmd = [
-                'ffmpeg', '-i', input_file,
+                'ffmpeg', '-i', 'pipe:0',
+                '-f', 'wav',
                 '-acodec', 'pcm_s16le',
                 '-ar', '16000',
                 '-ac', '1',
-                '-y',  # Overwrite output file
-                output_file
+                'pipe:1'
             ]
             
-            result = subprocess.run(cmd, capture_output=True, check=True)
-            return os.path.exists(output_file)
+            proc = await asyncio.create_subprocess_exec(
+                *cmd,
+                stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE
+            )
+            if isinstance(audio, bytes):
+                wav_data, stderr = await proc.communicate(input=audio)
+            else:
+                # Drain the output concurrently so ffmpeg never blocks on a full pipe
+                output = asyncio.gather(proc.stdout.read(), proc.stderr.read())
+                try:
+                    async for chunk in audio:
+                        proc.stdin.write(chunk)
+                        await proc.stdin.drain()
+                except (BrokenPipeError, ConnectionResetError):
+                    pass  # ffmpeg stopped reading; its exit status says why
+                except BaseException:
+                    proc.kill()
+                    raise
+                finally:
+                    proc.stdin.close()
+                    wav_data, stderr = await output
+                    await proc.wait()
+            
+            if proc.returncode != 0:
+                logger.error("❌ FFmpeg conversion failed: %s", stderr.decode(errors='replace').strip()[-200:])
+                return None
+            return wav_data
             
-        except subprocess.CalledProcessError as e:
-            logging.error(f"❌ FFmpeg conversion failed: {e}")
-            return False
         except Exception as e:
-            logging.error(f"❌ Audio conversion error: {e}")
-            return False
+            logger.error("❌ Audio conversion error: %s", e)
+            return None
 
 # =================== TEXT-TO-SPEECH CONVERTER ===================
 class TTSConverter:
-    def __init__(self, config):
+    # Keep speech files in RAM where tmpfs is available
+    TEMP_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    
+    def __init__(self, config, http_client: httpx.AsyncClient):
         self.config = config
+        self.http_client = http_client
     
     async def text_to_speech(self, text: str) -> Optional[str]:
         """Convert text to speech using Azure TTS and return the file path"""
@@ -136,42 +202,55 @@ class TTSConverter:
                 "voice": self.config.AZURE_TTS_VOICE
             }
             
-            logging.info(f"🔊 Converting text to speech: {text[:50]}...")
+            logger.info("🔊 Converting text to speech: %s...", text[:50])
             
             # Send POST request to generate speech
-            response = requests.post(tts_endpoint, headers=headers, json=payload)
+            response = await self.http_client.post(tts_endpoint, headers=headers, content=orjson.dumps(payload))
             
-            if response.ok:
-                # Create temporary file for the audio
-                temp_audio_file = tempfile.mktemp(suffix='.mp3')
-                
-                with open(temp_audio_file, "wb") as f:
+            if response.is_success:
+                # Create temporary file for the audio; the caller removes it once sent
+                with tempfile.NamedTemporaryFile(suffix='.mp3', dir=self.TEMP_DIR, delete=False) as f:
                     f.write(response.content)
                 
-                logging.info("✅ Text-to-speech conversion successful")
-                return temp_audio_file
+                logger.info("✅ Text-to-speech conversion successful")
+                return f.name
             else:
-                logging.error(f"❌ TTS request failed: {response.status_code} - {response.text}")
+                logger.error("❌ TTS request failed: %s - %s", response.status_code, response.text)
                 return None
                 
         except Exception as e:
-            logging.error(f"❌ TTS conversion error: {e}")
+            logger.error("❌ TTS conversion error: %s", e)
             return None
 
 # =================== PRODUCT CATALOG MANAGER ===================
 class ProductCatalog:
+    # Seconds between checks of the products file for edits
+    RELOAD_CHECK_INTERVAL = 5.0
+    
     def __init__(self, products_file: str):
         self.products_file = products_file
+        self._products_text = None
+        self._mtime = None
+        self._next_check = 0.0
         self.products = self.load_products()
     
+    def _file_mtime(self) -> Optional[int]:
+        try:
+            return os.stat(self.products_file).st_mtime_ns
+        except OSError:
+            return None
+    
     def load_products(self) -> List[Dict]:
         """Load products from JSON file"""
         if os.path.exists(self.products_file):
             try:
-                with open(self.products_file, 'r', encoding='utf-8') as f:
-                    return json.load(f)
+                self._mtime = self._file_mtime()
+                with open(self.products_file, 'rb') as f:
+                    products = orjson.loads(f.read())
+                self._products_text = self._build_products_text(products)
+                return products
             except Exception as e:
-                logging.error(f"❌ Error loading products: {e}")
+                logger.error("❌ Error loading products: %s", e)
         
         # Create sample products file if it doesn't exist
         sample_products = [
@@ -209,25 +288,53 @@ class ProductCatalog:
     
     def save_products(self, products: List[Dict]):
         """Save products to JSON file"""
+        self.products = products
+        self._products_text = self._build_products_text(products)
         try:
-            with open(self.products_file, 'w', encoding='utf-8') as f:
-                json.dump(products, f, indent=2, ensure_ascii=False)
+            with open(self.products_file, 'wb') as f:
+                f.write(orjson.dumps(products, option=orjson.OPT_INDENT_2))
+            self._mtime = self._file_mtime()
         except Exception as e:
-            logging.error(f"❌ Error saving products: {e}")
+            logger.error("❌ Error saving products: %s", e)
     
     def get_all_products_text(self) -> str:
-        """Get all available products as text"""
-        if not self.products:
+        """Get all available products as text (rebuilt only when products change)
+        
+        Edits made to the products file while the bot is running are picked
+        up within RELOAD_CHECK_INTERVAL seconds.
+        """
+        now = time.monotonic()
+        if now < self._next_check:
+            return self._products_text
+        self._next_check = now + self.RELOAD_CHECK_INTERVAL
+        
+        mtime = self._file_mtime()
+        if mtime is not None and mtime != self._mtime:
+            # Keep serving the current catalog if the edited file doesn't parse
+            self._mtime = mtime
+            try:
+                with open(self.products_file, 'rb') as f:
+                    products = orjson.loads(f.read())
+                self.products = products
+                self._products_text = self._build_products_text(products)
+                logger.info("📦 Products reloaded: %d", len(products))
+            except Exception as e:
+                logger.error("❌ Error reloading products: %s", e)
+        return self._products_text
+    
+    @staticmethod
+    def _build_products_text(products: List[Dict]) -> str:
+        if not products:
             return "No products currently available."
         
-        text = "📦 **Available Products:**\n\n"
-        for product in self.products:
+        parts = ["📦 **Available Products:**\n\n"]
+        for product in products:
             if product.get('available', True):
-                text += f"**{product['name']}**\n"
-                text += f"💰 Price: {product['price']} {product['currency']}\n"
-                text += f"📝 {product['description']}\n\n"
+                parts.append(f"**{product['name']}**\n")
+                parts.append(f"💰 Price: {product['price']} {product['currency']}\n")
+                parts.append(f"📝 {product['description']}\n\n")
         
-        return text
+        return "".join(parts)
 
 # =================== LOGGING SETUP ===================
 def setup_logging():
@@ -245,159 +352,470 @@ def setup_logging():
     logging.getLogger('telethon').setLevel(logging.WARNING)
 
 # =================== DATABASE MANAGER ===================
+# SQL statements are kept as module constants so sqlite3's per-connection
+# statement cache reuses the prepared statement instead of re-parsing it.
+SQL_LOG_CONVERSATION = """
+    INSERT INTO conversations (user_id, chat_id, user_message, bot_response, message_type, user_type)
+    VALUES (?, ?, ?, ?, ?, ?)
+"""
+
+SQL_UPDATE_USER_SESSION = """
+    INSERT INTO user_sessions (user_id, first_name, username, last_seen, message_count, user_type)
+    VALUES (?, ?, ?, CURRENT_TIMESTAMP, 1, ?)
+    ON CONFLICT(user_id) DO UPDATE SET
+        first_name = excluded.first_name,
+        username = excluded.username,
+        last_seen = excluded.last_seen,
+        message_count = message_count + 1,
+        user_type = excluded.user_type
+"""
+
+SQL_GET_USER_HISTORY = """
+    SELECT user_message, bot_response FROM conversations WHERE user_id = ? ORDER BY id DESC LIMIT ?
+"""
+
+SQL_GET_CACHED_RESPONSE = """
+    SELECT response, user_type FROM response_cache WHERE key = ? AND expires_at > ?
+"""
+
+SQL_CACHE_RESPONSE = """
+    INSERT OR REPLACE INTO response_cache (key, response, user_type, expires_at) VALUES (?, ?, ?, ?)
+"""
+
+SQL_PURGE_RESPONSE_CACHE = """
+    DELETE FROM response_cache WHERE expires_at <= ?
+"""
+
+# Connection tuning applied once when the connection is opened
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA cache_size=-20000",  # ~20 MB page cache
+)
+
+# Current schema version, stored in PRAGMA user_version
+SCHEMA_VERSION = 2
+
+# Background writer batching: at most this many write groups or this many
+# seconds' worth of writes are committed in a single transaction
+WRITE_BATCH_SIZE = 64
+WRITE_BATCH_WINDOW = 0.1
+
+# Seconds between purges of expired response_cache rows
+RESPONSE_CACHE_PURGE_INTERVAL = 3600
+
 class DatabaseManager:
-    def __init__(self, db_path: str = None):
+    def __init__(self, db_path: str = None, history_length: int = None, history_cache_size: int = None):
         self.db_path = db_path or os.getenv("DATABASE_PATH", "telegram_bot.db")
-        self.init_database()
+        self.conn: Optional[aiosqlite.Connection] = None
+        
+        # Number of most recent messages returned as a user's history
+        self.history_length = history_length or int(os.getenv("MAX_HISTORY_LENGTH", "8"))
+        
+        # In-memory LRU of conversation histories; this process is the only
+        # writer, so the database only needs to be read on a cache miss
+        self.history_cache_size = history_cache_size or int(os.getenv("HISTORY_CACHE_SIZE", "10000"))
+        self._history_cache: OrderedDict[int, List[str]] = OrderedDict()
+        
+        # Writes are queued and committed in batches by a single writer task
+        self._write_queue: Optional[asyncio.Queue] = None
+        self._writer_task: Optional[asyncio.Task] = None
+        self._pending_writes = 0
+        
+        # Expired response_cache rows are purged alongside cache writes
+        self._next_cache_purge = 0.0
     
-    def init_database(self):
+    async def init(self):
+        """Open the long-lived connection, tune it and initialize the schema"""
+        self.conn = await aiosqlite.connect(self.db_path)
+        for pragma in SQLITE_PRAGMAS:
+            await self.conn.execute(pragma)
+        await self.init_database()
+        
+        self._write_queue = asyncio.Queue()
+        self._writer_task = asyncio.create_task(self._writer())
+    
+    async def close(self):
+        """Flush queued writes and close the database connection"""
+        if self._writer_task is not None:
+            self._write_queue.put_nowait(None)  # Shutdown sentinel
+            await self._writer_task
+            self._writer_task = None
+        if self.conn is not None:
+            await self.conn.close()
+            self.conn = None
+    
+    async def init_database(self):
         """Initialize database tables with proper schema"""
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            
-            # Create conversations table
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS conversations (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER NOT NULL,
-                    chat_id INTEGER NOT NULL,
-                    user_message TEXT NOT NULL,
-                    bot_response TEXT NOT NULL,
-                    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-                    message_type TEXT DEFAULT 'private'
-                )
-            """)
-            
-            # Add user_type column if it doesn't exist
-            try:
-                cursor.execute("ALTER TABLE conversations ADD COLUMN user_type TEXT DEFAULT 'unknown'")
-                logging.info("✅ Added user_type column to conversations table")
-            except sqlite3.OperationalError:
-                pass
+        # Create conversations table
+        await self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS conversations (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                chat_id INTEGER NOT NULL,
+                user_message TEXT NOT NULL,
+                bot_response TEXT NOT NULL,
+                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+                message_type TEXT DEFAULT 'private'
+            )
+        """)
+        
+        # Create user_sessions table
+        await self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS user_sessions (
+                user_id INTEGER PRIMARY KEY,
+                first_name TEXT,
+                username TEXT,
+                last_seen DATETIME DEFAULT CURRENT_TIMESTAMP,
+                message_count INTEGER DEFAULT 0
+            )
+        """)
+        
+        # Index conversations for per-user history; entries within a user are
+        # ordered by rowid, so ORDER BY id needs no separate sort
+        await self.conn.execute("CREATE INDEX IF NOT EXISTS idx_conv_user ON conversations(user_id)")
+        
+        # Create response_cache table and drop entries that expired while offline
+        await self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS response_cache (
+                key TEXT PRIMARY KEY,
+                response TEXT NOT NULL,
+                user_type TEXT NOT NULL,
+                expires_at INTEGER NOT NULL
+            )
+        """)
+        await self.conn.execute(SQL_PURGE_RESPONSE_CACHE, (int(time.time()),))
+        
+        await self.migrate()
+        await self.conn.commit()
+        
+        # Refresh planner statistics; analysis_limit keeps this cheap on large tables
+        await self.conn.execute("PRAGMA analysis_limit=1000")
+        await self.conn.execute("ANALYZE")
+    
+    async def migrate(self):
+        """Apply schema migrations newer than the database's user_version"""
+        rows = await self.conn.execute_fetchall("PRAGMA user_version")
+        version = rows[0][0]
+        
+        if version < 1:
+            # Add user_type columns (databases from older versions may already have them)
+            for table in ("conversations", "user_sessions"):
+                columns = await self.conn.execute_fetchall(f"PRAGMA table_info({table})")
+                if not any(column[1] == "user_type" for column in columns):
+                    await self.conn.execute(f"ALTER TABLE {table} ADD COLUMN user_type TEXT DEFAULT 'unknown'")
+                    logger.info("✅ Added user_type column to %s table", table)
+        
+        if version < 2:
+            # History is now read from conversations, so drop the JSON blob
+            # column older versions kept it in
+            columns = await self.conn.execute_fetchall("PRAGMA table_info(user_sessions)")
+            if any(column[1] == "conversation_history" for column in columns):
+                try:
+                    await self.conn.execute("ALTER TABLE user_sessions DROP COLUMN conversation_history")
+                    logger.info("✅ Dropped conversation_history column from user_sessions table")
+                except aiosqlite.OperationalError as e:
+                    # DROP COLUMN needs SQLite 3.35+; nothing reads the column anyway
+                    logger.warning("⚠️  Could not drop user_sessions.conversation_history: %s", e)
+        
+        if version < SCHEMA_VERSION:
+            await self.conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+    
+    def record_turn(self, user_id: int, chat_id: int, user_message: str, bot_response: str,
+                    message_type: str, user_type: str, first_name: str, username: str):
+        """Record a conversation turn: log it (which also extends the user's history) and update their profile
+        
+        All writes for the turn are queued as one group, so they are always
+        committed together in a single transaction.
+        """
+        history = self._history_cache.get(user_id)
+        if history is not None:
+            self._cache_history(user_id, (history + [user_message, bot_response])[-self.history_length:])
+        
+        self._enqueue_writes(
+            (SQL_LOG_CONVERSATION, (user_id, chat_id, user_message, bot_response, message_type, user_type)),
+            (SQL_UPDATE_USER_SESSION, (user_id, first_name, username, user_type)),
+        )
+    
+    async def get_cached_response(self, key: str) -> Optional[tuple[str, str]]:
+        """Get an unexpired cached (response, user_type) for a prompt key
+        
+        Blank responses are never served, since Telegram can't send them.
+        """
+        rows = await self.conn.execute_fetchall(SQL_GET_CACHED_RESPONSE, (key, int(time.time())))
+        if not rows or not rows[0][0].strip():
+            return None
+        return tuple(rows[0])
+    
+    def cache_response(self, key: str, response: str, user_type: str, ttl: int):
+        """Cache a response for `ttl` seconds, purging expired entries at most hourly"""
+        if not response.strip():
+            return
+        
+        now = int(time.time())
+        statements = [(SQL_CACHE_RESPONSE, (key, response, user_type, now + ttl))]
+        
+        if time.monotonic() >= self._next_cache_purge:
+            self._next_cache_purge = time.monotonic() + RESPONSE_CACHE_PURGE_INTERVAL
+            statements.append((SQL_PURGE_RESPONSE_CACHE, (now,)))
+        
+        self._enqueue_writes(*statements)
+    
+    def _enqueue_writes(self, *statements: tuple):
+        """Queue (sql, params) statements to be committed in the same transaction"""
+        self._pending_writes += 1
+        self._write_queue.put_nowait(statements)
+    
+    async def flush(self):
+        """Wait until every write queued so far has been committed"""
+        if not self._pending_writes:
+            return
+        barrier = asyncio.get_running_loop().create_future()
+        self._write_queue.put_nowait(barrier)
+        await barrier
+    
+    async def _writer(self):
+        """Drain the write queue, committing each batch in one transaction"""
+        loop = asyncio.get_running_loop()
+        running = True
+        
+        while running:
+            item = await self._write_queue.get()
+            batch, barriers = [], []
+            deadline = loop.time() + WRITE_BATCH_WINDOW
             
-            # Create user_sessions table
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS user_sessions (
-                    user_id INTEGER PRIMARY KEY,
-                    first_name TEXT,
-                    username TEXT,
-                    last_seen DATETIME DEFAULT CURRENT_TIMESTAMP,
-                    message_count INTEGER DEFAULT 0,
-                    conversation_history TEXT DEFAULT '[]'
-                )
-            """)
+            while True:
+                if item is None:
+                    running = False
+                    break
+                if isinstance(item, asyncio.Future):
+                    # Someone is waiting on this batch - commit right away
+                    barriers.append(item)
+                    break
+                batch.append(item)
+                if len(batch) >= WRITE_BATCH_SIZE:
+                    break
+                
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._write_queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
             
-            # Add user_type column if it doesn't exist
+            if batch:
+                await self._write_batch(batch)
+                self._pending_writes -= len(batch)
+            for barrier in barriers:
+                if not barrier.done():
+                    barrier.set_result(None)
+    
+    async def _write_batch(self, batch: List[tuple]):
+        # Each statement touches a single table and keyed writes keep their
+        # order within a group, so rows can be grouped per statement and sent
+        # with one executemany each
+        rows_by_sql: Dict[str, List[tuple]] = {}
+        for statements in batch:
+            for sql, params in statements:
+                rows_by_sql.setdefault(sql, []).append(params)
+        
+        try:
+            await self.conn.execute("BEGIN IMMEDIATE")
+            for sql, rows in rows_by_sql.items():
+                await self.conn.executemany(sql, rows)
+            await self.conn.commit()
+        except Exception as e:
+            logger.error("❌ Error writing %d queued database writes: %s", len(batch), e)
             try:
-                cursor.execute("ALTER TABLE user_sessions ADD COLUMN user_type TEXT DEFAULT 'unknown'")
-                logging.info("✅ Added user_type column to user_sessions table")
-            except sqlite3.OperationalError:
+                await self.conn.rollback()
+            except Exception:
                 pass
-            
-            conn.commit()
-    
-    def log_conversation(self, user_id: int, chat_id: int, user_message: str, 
-                        bot_response: str, message_type: str = 'private', user_type: str = 'unknown'):
-        with sqlite3.connect(self.db_path) as conn:
-            conn.execute("""
-                INSERT INTO conversations (user_id, chat_id, user_message, bot_response, message_type, user_type)
-                VALUES (?, ?, ?, ?, ?, ?)
-            """, (user_id, chat_id, user_message, bot_response, message_type, user_type))
-    
-    def update_user_session(self, user_id: int, first_name: str, username: str, 
-                           conversation_history: List[str], user_type: str = 'unknown'):
-        history_json = json.dumps(conversation_history, ensure_ascii=False)
-        with sqlite3.connect(self.db_path) as conn:
-            conn.execute("""
-                INSERT OR REPLACE INTO user_sessions 
-                (user_id, first_name, username, last_seen, message_count, conversation_history, user_type)
-                VALUES (?, ?, ?, CURRENT_TIMESTAMP, 
-                       COALESCE((SELECT message_count FROM user_sessions WHERE user_id = ?) + 1, 1), ?, ?)
-            """, (user_id, first_name, username, user_id, history_json, user_type))
-    
-    def get_user_history(self, user_id: int) -> List[str]:
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.execute("""
-                SELECT conversation_history FROM user_sessions WHERE user_id = ?
-            """, (user_id,))
-            result = cursor.fetchone()
-            if result and result[0]:
-                try:
-                    return json.loads(result[0])
-                except json.JSONDecodeError:
-                    return []
-            return []
+    
+    def _cache_history(self, user_id: int, history: List[str]):
+        self._history_cache[user_id] = history
+        self._history_cache.move_to_end(user_id)
+        while len(self._history_cache) > self.history_cache_size:
+            self._history_cache.popitem(last=False)
+    
+    async def get_user_history(self, user_id: int) -> List[str]:
+        history = self._history_cache.get(user_id)
+        if history is not None:
+            self._history_cache.move_to_end(user_id)
+            return history
+        
+        # An evicted entry may still have its write queued
+        await self.flush()
+        
+        # Each conversation row is one turn, i.e. two history entries
+        turns = (self.history_length + 1) // 2
+        rows = await self.conn.execute_fetchall(SQL_GET_USER_HISTORY, (user_id, turns))
+        history = [text for row in reversed(rows) for text in row][-self.history_length:]
+        
+        self._cache_history(user_id, history)
+        return history
 
 # =================== AI RESPONDER ===================
 class AIResponder:
-    def __init__(self, config: Config):
+    # End of the first sentence in a streamed response, including the Arabic
+    # question mark and full stop used in Darija replies
+    SENTENCE_END = re.compile(r"[.!?…؟۔](?=\s)|\n")
+    
+    # Stripped from messages before computing response cache keys
+    PUNCTUATION = re.compile(r"[^\w\s]")
+    
+    # Sales vocabulary that marks a response as aimed at a customer
+    CUSTOMER_KEYWORDS = re.compile(r"product|price|buy|sale", re.IGNORECASE)
+    
+    # Audio formats Whisper accepts directly, without ffmpeg conversion
+    WHISPER_FORMATS = {'.flac', '.m4a', '.mp3', '.mp4', '.mpeg', '.mpga', '.oga', '.ogg', '.wav', '.webm'}
+    
+    # Batched requests: each conversation and each reply is introduced by
+    # a numbered delimiter line so the combined output can be split back
+    BATCH_DELIMITER = re.compile(r"^=== MSG (\d+) ===[ \t]*$", re.MULTILINE)
+    BATCH_INSTRUCTIONS = (
+        "You are answering {count} independent conversations at once. Each conversation "
+        "starts with a line '=== MSG n ===' followed by its messages. Reply to every "
+        "conversation separately and never mix information between them. Output exactly "
+        "{count} replies, each starting with its own '=== MSG n ===' line followed only by "
+        "the reply text."
+    )
+    
+    def __init__(self, config: Config, response_cache: Optional["DatabaseManager"] = None):
         self.config = config
+        self.response_cache = response_cache
         self.product_catalog = ProductCatalog(config.PRODUCTS_FILE)
-        self.audio_converter = AudioConverter()
-        self.tts_converter = TTSConverter(config)
+        
+        # One pooled HTTP/2 client shared by all Azure requests, so
+        # connections are kept alive instead of re-doing TLS handshakes
+        self.http_client = httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(max_keepalive_connections=32, max_connections=64),
+            timeout=httpx.Timeout(30, connect=5)
+        )
+        self.tts_converter = TTSConverter(config, self.http_client)
         self.setup_openai()
+        
+        # Bound in-flight Azure requests and keep under the per-minute quota
+        self._semaphore = asyncio.Semaphore(config.AZURE_MAX_CONCURRENCY)
+        self._rate_limiter = AsyncLimiter(config.AZURE_MAX_RPM, 60)
+        
+        # Bound concurrent ffmpeg processes
+        self._ffmpeg_semaphore = asyncio.Semaphore(config.FFMPEG_CONCURRENCY)
+        
+        # System prompt, cached per product catalog text
+        self._system_prompt = None
+        self._prompt_products_text = None
+        
+        # In-flight generations keyed by (user id, message hash)
+        self._inflight: Dict[tuple[int, bytes], asyncio.Task] = {}
+        
+        # Round-robin over chat deployments; a retry moves on to the next one
+        self._deployments = itertools.cycle(self.config.AZURE_DEPLOYMENTS)
+        
+        # Micro-batcher state
+        self._pending_batch: List[tuple[asyncio.Future, List[Dict]]] = []
+        self._batch_timer: Optional[asyncio.TimerHandle] = None
+        self._batch_tasks = set()
     
     def setup_openai(self):
         try:
-            self.client = AzureOpenAI(
+            self.client = AsyncAzureOpenAI(
                 api_version=self.config.AZURE_API_VERSION,
                 azure_endpoint=self.config.AZURE_ENDPOINT,
                 api_key=self.config.AZURE_API_KEY,
+                max_retries=0,  # Retries are handled by call_azure
+                http_client=self.http_client,
             )
             
             # Check if ffmpeg is available for audio conversion
-            self.ffmpeg_available = self.audio_converter.check_ffmpeg()
+            self.ffmpeg_available = ffmpeg_available()
             if self.ffmpeg_available:
-                logging.info(f"✅ Azure OpenAI client initialized with speech-to-text support")
+                logger.info("✅ Azure OpenAI client initialized with speech-to-text support")
             else:
-                logging.warning(f"⚠️  Azure OpenAI client initialized but ffmpeg not found - voice messages will be limited")
+                logger.warning("⚠️  Azure OpenAI client initialized but ffmpeg not found - voice messages will be limited")
                 
         except Exception as e:
-            logging.error(f"❌ Failed to initialize Azure OpenAI: {e}")
+            logger.error("❌ Failed to initialize Azure OpenAI: %s", e)
             raise
     
-    async def transcribe_audio(self, audio_file_path: str) -> str:
-        """Transcribe audio file to text using Azure OpenAI Whisper"""
+    async def close(self):
+        """Close the shared HTTP client"""
+        await self.http_client.aclose()
+    
+    async def transcribe_audio(self, audio: io.BytesIO) -> str:
+        """Transcribe in-memory audio to text using Azure OpenAI Whisper
+        
+        `audio.name` must carry the file extension, which tells Whisper the format.
+        """
+        # Telegram voice notes (OGG/Opus) and other common formats go to
+        # Whisper straight from memory; only the rest need converting with ffmpeg
+        suffix = os.path.splitext(audio.name)[1].lower()
+        if suffix in self.WHISPER_FORMATS:
+            try:
+                logger.info("🎤 Transcribing audio...")
+                return await self._transcribe_bytes(audio.name, audio.getvalue())
+            except Exception as e:
+                logger.error("❌ Speech-to-text error: %s", e)
+                return "[Voice message - transcription failed]"
+        
         if not self.ffmpeg_available:
             return "[Voice message - audio conversion not available (ffmpeg required)]"
         
-        temp_wav_file = None
+        return await self.transcribe_converted(audio.getvalue())
+    
+    async def transcribe_converted(self, audio: Union[bytes, AsyncIterable[bytes]]) -> str:
+        """Transcribe audio in a format Whisper can't read, converting it with ffmpeg first
+        
+        `audio` may be an async iterable of downloaded chunks; see AudioConverter.convert_to_wav.
+        """
         try:
-            # Create temporary WAV file
-            temp_wav_file = tempfile.mktemp(suffix='.wav')
-            
             # Convert audio to WAV format
-            logging.info("🔄 Converting audio format...")
-            if not self.audio_converter.convert_to_wav(audio_file_path, temp_wav_file):
+            logger.info("🔄 Converting audio format...")
+            async with self._ffmpeg_semaphore:
+                wav_data = await AudioConverter.convert_to_wav(audio)
+            if not wav_data:
                 return "[Voice message - audio conversion failed]"
             
             # Transcribe the converted audio
-            logging.info("🎤 Transcribing converted audio...")
-            with open(temp_wav_file, "rb") as audio_file:
-                result = self.client.audio.transcriptions.create(
-                    file=audio_file,
-                    model=self.config.AZURE_WHISPER_DEPLOYMENT
-                )
-                return result.text
-                
+            logger.info("🎤 Transcribing converted audio...")
+            return await self._transcribe_bytes("audio.wav", wav_data)
+            
         except Exception as e:
-            logging.error(f"❌ Speech-to-text error: {e}")
+            logger.error("❌ Speech-to-text error: %s", e)
             return "[Voice message - transcription failed]"
-        finally:
-            # Clean up temporary file
-            if temp_wav_file and os.path.exists(temp_wav_file):
-                try:
-                    os.remove(temp_wav_file)
-                except:
-                    pass
     
-    def create_smart_system_prompt(self, user_name: str, conversation_history: List[str]) -> str:
-        """Create AI-powered dynamic system prompt"""
+    async def _transcribe_bytes(self, filename: str, data: bytes) -> str:
+        result = await self.call_azure(lambda: self.client.audio.transcriptions.create(
+            file=(filename, data),
+            model=self.config.AZURE_WHISPER_DEPLOYMENT
+        ))
+        return result.text
+    
+    def create_smart_system_prompt(self) -> str:
+        """Create AI-powered dynamic system prompt
+        
+        The prompt holds no per-user data, so it stays byte-identical across
+        requests and Azure can serve it from its prompt cache. It is rebuilt
+        only when the product catalog text changes, e.g. after the products
+        file is edited on disk.
+        """
         
         # Get products info
         products_info = self.product_catalog.get_all_products_text()
         
-        return f"""You are a smart, multilingual AI assistant replying on behalf of {self.config.OWNER_NAME}, who is currently unavailable.
+        if products_info is not self._prompt_products_text:
+            self._system_prompt = self._build_system_prompt(products_info)
+            self._prompt_products_text = products_info
+        
+        return self._system_prompt
+    
+    def _build_system_prompt(self, products_info: str) -> str:
+        owner_name = self.config.OWNER_NAME
+        
+        return f"""You are a smart, multilingual AI assistant replying on behalf of {owner_name}, who is currently unavailable.
 
 ✨ **CRITICAL INSTRUCTIONS**:
 - Keep replies SHORT and clear (2–3 sentences max)
@@ -405,26 +823,26 @@ class AIResponder:
 - Use emojis to keep tone light and friendly (where appropriate)
 - Be creative — avoid repetitive responses!
 - ❗️ **NEVER reveal or mention the AI model you are using**
-    - If asked, always reply: **"I'm powered by {self.config.OWNER_NAME} ✨"**
-- never share any personal information about {self.config.OWNER_NAME} or yourself
+    - If asked, always reply: **"I'm powered by {owner_name} ✨"**
+- never share any personal information about {owner_name} or yourself
 
 📌 **CONTEXT ANALYSIS**:
 Analyze the incoming message and recent conversation history to decide:
 1. Is this a **FRIEND/FAMILY** checking in casually?
-   - Let them know {self.config.OWNER_NAME} is away and will reply later
+   - Let them know {owner_name} is away and will reply later
    - Ask if they need help with anything
    - Be relaxed, funny ,love , and warm 😄  
-   - Add a personal touch if possible (e.g. "Hey {user_name}, hope you're doing great! {self.config.OWNER_NAME} is away but will get back to you soon! 🤗✨")
+   - Add a personal touch if possible (e.g. "Hey <their name>, hope you're doing great! {owner_name} is away but will get back to you soon! 🤗✨")
    - try to open a conversation if possible try ur best to open a conversation with them
 
 2. Is this a **CUSTOMER/BUSINESS** inquiry?
    - Be professional but friendly
    - If they’re asking about products or services, mention relevant items from the catalog
-   - Offer prices if applicable and suggest contacting {self.config.OWNER_NAME} to complete the order 🛍️
+   - Offer prices if applicable and suggest contacting {owner_name} to complete the order 🛍️
 
 3. Are they asking a **general question or seeking help**?
    - Offer simple, helpful answers if possible
-   - Let them know {self.config.OWNER_NAME} will get back to them soon
+   - Let them know {owner_name} will get back to them soon
 
 🛒 **PRODUCTS / SERVICES AVAILABLE**:
 {products_info}
@@ -434,159 +852,479 @@ Analyze the incoming message and recent conversation history to decide:
 ➡️ **IF CUSTOMER/BUSINESS**:
 - Stay professional and helpful
 - Share product/service info clearly (with prices if possible)
-- Encourage them to reach out to {self.config.OWNER_NAME} for buying or more help
+- Encourage them to reach out to {owner_name} for buying or more help
 - Be polite, brief, and sales-positive — but not pushy
 
 ➡️ **IF FRIEND/FAMILY**:
 - Use a casual and friendly tone
-- Say {self.config.OWNER_NAME} is away but will respond soon
+- Say {owner_name} is away but will respond soon
 - Offer basic help if you can
 - Add charm and humor 🤗✨
 
 ➡️ **IF GENERAL QUESTION**:
 - Be polite and helpful
 - Keep it simple
-- Let them know {self.config.OWNER_NAME} will reply when available
-
-📍 **Current user**: {user_name}  
-📜 **Recent messages**: {conversation_history[-4:] if conversation_history else "First message"}
-""
+- Let them know {owner_name} will reply when available
 
+The current user's name is given at the start of their latest message.
 
 Remember: BE CONCISE, HELPFUL, and MATCH THE USER'S LANGUAGE!"""
     
-    async def generate_response(self, user_message: str, user_name: str, 
-                              conversation_history: List[str]) -> tuple[str, str]:
-        """Generate AI response with dynamic context awareness"""
+    async def generate_response(self, user_id: int, user_message: str, user_name: str, 
+                              conversation_history: List[str],
+                              first_sentence: Optional[asyncio.Future] = None) -> tuple[str, str]:
+        """Generate AI response with dynamic context awareness
+        
+        The completion is streamed; if `first_sentence` is given it is resolved
+        with the first complete sentence as soon as it arrives (or with the
+        whole response if it never ends a sentence early).
+        
+        Identical messages from the same user that arrive while a response is
+        still being generated share that response instead of calling Azure again.
+        """
+        key = (user_id, hashlib.blake2b(user_message.encode(), digest_size=8).digest())
+        
+        generation = self._inflight.get(key)
+        if generation is None:
+            generation = asyncio.create_task(self._generate_response(
+                user_message, user_name, conversation_history, first_sentence
+            ))
+            self._inflight[key] = generation
+            generation.add_done_callback(lambda _: self._inflight.pop(key, None))
+            
+            # Shielded so a cancelled caller doesn't cancel it for the others
+            return await asyncio.shield(generation)
+        
+        ai_response, user_type = await asyncio.shield(generation)
+        if first_sentence is not None and not first_sentence.done():
+            first_sentence.set_result(ai_response)
+        return ai_response, user_type
+    
+    async def _generate_response(self, user_message: str, user_name: str, 
+                                 conversation_history: List[str],
+                                 first_sentence: Optional[asyncio.Future]) -> tuple[str, str]:
         try:
             # Create smart system prompt
-            system_prompt = self.create_smart_system_prompt(user_name, conversation_history)
+            system_prompt = self.create_smart_system_prompt()
             
             # Prepare messages
             context_messages = [{"role": "system", "content": system_prompt}]
             
-            # Add recent conversation history
-            for i, msg in enumerate(conversation_history[-4:]):
+            # Add recent conversation history (already trimmed by the caller)
+            for i, msg in enumerate(conversation_history):
                 role = "user" if i % 2 == 0 else "assistant"
                 context_messages.append({"role": role, "content": msg})
             
-            context_messages.append({"role": "user", "content": user_message})
+            # Per-user details go at the tail so the system prompt prefix stays cacheable
+            context_messages.append({"role": "user", "content": f"Current user: {user_name}\n\n{user_message}"})
+            
+            # Serve repeated prompts from the response cache
+            cache_key = None
+            if self.response_cache is not None and self.config.RESPONSE_CACHE_TTL > 0:
+                cache_key = self.response_cache_key(system_prompt, user_name, user_message, conversation_history)
+                cached = await self.response_cache.get_cached_response(cache_key)
+                if cached is not None:
+                    logger.info("💾 Serving cached response")
+                    if first_sentence is not None and not first_sentence.done():
+                        first_sentence.set_result(cached[0])
+                    return cached
             
             # Generate response
-            response = self.client.chat.completions.create(
-                messages=context_messages,
-                max_tokens=self.config.MAX_RESPONSE_TOKENS,
-                temperature=0.8,
-                top_p=0.9,
-                model=self.config.AZURE_DEPLOYMENT
-            )
+            if self.config.LLM_BATCH_SIZE > 1:
+                ai_response = await self.batched_completion(context_messages)
+            else:
+                ai_response = await self.streamed_completion(context_messages, first_sentence)
             
-            ai_response = response.choices[0].message.content.strip()
+            # A tripped content filter can leave the reply blank; use the fallback instead
+            if not ai_response:
+                raise ValueError("Azure returned an empty response")
+            
+            if first_sentence is not None and not first_sentence.done():
+                first_sentence.set_result(ai_response)
             
             # AI determines user type based on response content
-            user_type = "customer" if any(word in ai_response.lower() for word in ["product", "price", "buy", "sale"]) else "friend"
+            user_type = "customer" if self.CUSTOMER_KEYWORDS.search(ai_response) else "friend"
+            
+            if cache_key is not None:
+                self.response_cache.cache_response(cache_key, ai_response, user_type, self.config.RESPONSE_CACHE_TTL)
             
             return ai_response, user_type
             
         except Exception as e:
-            logging.error(f"❌ OpenAI API Error: {e}")
+            logger.error("❌ OpenAI API Error: %s", e)
             
             # Simple fallback
             fallback = f"Hi {user_name}! {self.config.OWNER_NAME} is away but I'll let them know you messaged 😊"
+            if first_sentence is not None and not first_sentence.done():
+                first_sentence.set_result(fallback)
             return fallback, 'unknown'
+    
+    def response_cache_key(self, system_prompt: str, user_name: str, user_message: str, 
+                           conversation_history: List[str]) -> str:
+        """Hash everything a response depends on, with the message normalized
+        
+        Case, punctuation and whitespace are ignored, so "Hi!" and "hi" share a key.
+        """
+        normalized = " ".join(self.PUNCTUATION.sub("", user_message.lower()).split())
+        payload = orjson.dumps([system_prompt, user_name, normalized, conversation_history])
+        return hashlib.sha256(payload).hexdigest()
+    
+    async def call_azure(self, make_request):
+        """Run an Azure OpenAI request within the concurrency and rate limits
+        
+        Rate limiting, connection/timeout errors and 5xx responses are retried
+        with exponential backoff, up to AZURE_MAX_RETRIES attempts.
+        """
+        for attempt in range(self.config.AZURE_MAX_RETRIES):
+            try:
+                async with self._semaphore, self._rate_limiter:
+                    return await make_request()
+            except (RateLimitError, APIConnectionError, InternalServerError) as e:
+                if attempt == self.config.AZURE_MAX_RETRIES - 1:
+                    raise
+                delay = 2 ** attempt + random.random()
+                logger.warning("⚠️  Azure request failed (%s), retrying in %.1fs", type(e).__name__, delay)
+                await asyncio.sleep(delay)
+    
+    async def text_to_speech(self, text: str) -> Optional[str]:
+        """Convert text to speech within the Azure concurrency limit
+        
+        TTS has its own quota, so it doesn't draw from the chat rate limiter,
+        and failures fall back to a text reply rather than being retried.
+        """
+        async with self._semaphore:
+            return await self.tts_converter.text_to_speech(text)
+    
+    async def completion(self, messages: List[Dict], max_tokens: int = None) -> str:
+        """Run a single non-streamed chat completion"""
+        async def request():
+            return await self.client.chat.completions.create(
+                messages=messages,
+                max_tokens=max_tokens or self.config.MAX_RESPONSE_TOKENS,
+                temperature=0.8,
+                top_p=0.9,
+                model=next(self._deployments)
+            )
+        
+        response = await self.call_azure(request)
+        return response.choices[0].message.content.strip()
+    
+    async def streamed_completion(self, messages: List[Dict], 
+                                  first_sentence: Optional[asyncio.Future] = None) -> str:
+        """Run a streamed chat completion, resolving `first_sentence` early"""
+        return await self.call_azure(lambda: self._stream(messages, first_sentence))
+    
+    async def _stream(self, messages: List[Dict], first_sentence: Optional[asyncio.Future]) -> str:
+        stream = await self.client.chat.completions.create(
+            messages=messages,
+            max_tokens=self.config.MAX_RESPONSE_TOKENS,
+            temperature=0.8,
+            top_p=0.9,
+            model=next(self._deployments),
+            stream=True
+        )
+        
+        parts = []
+        async for chunk in stream:
+            # Azure sends content-filter chunks without choices
+            if not chunk.choices or not chunk.choices[0].delta.content:
+                continue
+            parts.append(chunk.choices[0].delta.content)
+            
+            if first_sentence is not None and not first_sentence.done():
+                text = "".join(parts).lstrip()
+                match = self.SENTENCE_END.search(text)
+                if match:
+                    first_sentence.set_result(text[:match.end()].strip())
+        
+        return "".join(parts).strip()
+    
+    def batched_completion(self, messages: List[Dict]) -> asyncio.Future:
+        """Queue a completion for the micro-batcher
+        
+        Requests arriving within LLM_BATCH_WINDOW of each other (up to
+        LLM_BATCH_SIZE of them) are sent to Azure as one chat completion.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending_batch.append((future, messages))
+        
+        if len(self._pending_batch) >= self.config.LLM_BATCH_SIZE:
+            self._dispatch_batch()
+        elif self._batch_timer is None:
+            self._batch_timer = loop.call_later(self.config.LLM_BATCH_WINDOW, self._dispatch_batch)
+        return future
+    
+    def _dispatch_batch(self):
+        if self._batch_timer is not None:
+            self._batch_timer.cancel()
+            self._batch_timer = None
+        
+        batch, self._pending_batch = self._pending_batch, []
+        if batch:
+            task = asyncio.create_task(self._run_batch(batch))
+            self._batch_tasks.add(task)
+            task.add_done_callback(self._batch_tasks.discard)
+    
+    async def _run_batch(self, batch: List[tuple[asyncio.Future, List[Dict]]]):
+        try:
+            if len(batch) == 1:
+                replies = [await self.completion(batch[0][1])]
+            else:
+                combined = await self.completion(
+                    self._build_batch_messages(batch),
+                    max_tokens=self.config.MAX_RESPONSE_TOKENS * len(batch)
+                )
+                replies = self._split_batch_reply(combined, len(batch))
+        except Exception as e:
+            for future, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        
+        missing = []
+        for (future, messages), reply in zip(batch, replies):
+            if future.done():
+                continue
+            if reply:
+                future.set_result(reply)
+            else:
+                missing.append((future, messages))
+        
+        # Replies the model dropped from the combined output are asked for on their own
+        await asyncio.gather(*(self._complete_into(future, messages) for future, messages in missing))
+    
+    async def _complete_into(self, future: asyncio.Future, messages: List[Dict]):
+        try:
+            reply = await self.completion(messages)
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+        else:
+            if not future.done():
+                future.set_result(reply)
+    
+    def _build_batch_messages(self, batch: List[tuple[asyncio.Future, List[Dict]]]) -> List[Dict]:
+        """Marshal several conversations into a single chat completion request"""
+        # Send the system prompt once when every conversation shares it
+        system_prompts = {messages[0]["content"] for _, messages in batch}
+        shared_system = system_prompts.pop() if len(system_prompts) == 1 else None
+        
+        blocks = []
+        for number, (_, messages) in enumerate(batch, 1):
+            lines = [f"=== MSG {number} ==="]
+            for message in messages:
+                if shared_system is not None and message["role"] == "system":
+                    continue
+                lines.append(f"[{message['role']}]\n{message['content']}")
+            blocks.append("\n\n".join(lines))
+        
+        instructions = self.BATCH_INSTRUCTIONS.format(count=len(batch))
+        if shared_system is not None:
+            instructions += f"\n\nInstructions for every conversation:\n{shared_system}"
+        
+        return [
+            {"role": "system", "content": instructions},
+            {"role": "user", "content": "\n\n".join(blocks)}
+        ]
+    
+    def _split_batch_reply(self, text: str, count: int) -> List[Optional[str]]:
+        """Split a combined reply back into one reply per conversation"""
+        replies = [None] * count
+        parts = self.BATCH_DELIMITER.split(text)
+        
+        # parts is [preamble, number, reply, number, reply, ...]
+        for number, reply in zip(parts[1::2], parts[2::2]):
+            index = int(number) - 1
+            if 0 <= index < count and reply.strip():
+                replies[index] = reply.strip()
+        return replies
 
 # =================== MAIN BOT CLASS ===================
 class TelegramAutoResponder:
+    # Largest part Telegram serves per file request
+    DOWNLOAD_PART_SIZE = 512 * 1024
+    
     def __init__(self):
         self.config = Config()
         self.client = TelegramClient("auto_responder_session", 
                                    self.config.API_ID, 
                                    self.config.API_HASH)
-        self.db = DatabaseManager()
-        self.ai = AIResponder(self.config)
+        self.db = DatabaseManager(history_length=self.config.MAX_HISTORY_LENGTH)
+        self.ai = AIResponder(self.config, response_cache=self.db)
         self.my_id = None
+        
+        # Bounds in-flight media part requests across all downloads
+        self._download_semaphore = asyncio.Semaphore(self.config.DOWNLOAD_CONCURRENCY)
     
     async def start(self):
-        await self.client.start(phone=self.config.PHONE_NUMBER)
-        me = await self.client.get_me()
-        self.my_id = me.id
+        await self.db.init()
+        try:
+            await self.client.start(phone=self.config.PHONE_NUMBER)
+            me = await self.client.get_me()
+            self.my_id = me.id
+            
+            logger.info("🤖 Enhanced Auto-responder started for %s", me.first_name)
+            logger.info("📦 Products loaded: %d", len(self.ai.product_catalog.products))
+            logger.info("🚀 Bot ready - AI-powered dynamic responses!")
+            
+            if self.ai.ffmpeg_available:
+                logger.info("🎤 Speech-to-text enabled for voice messages")
+            else:
+                logger.warning("⚠️  Speech-to-text limited - install ffmpeg for full support")
+            
+            # Check if TTS is properly configured
+            if self.config.AZURE_TTS_MODEL and self.config.AZURE_TTS_VOICE:
+                logger.info("🔊 Text-to-speech enabled - will respond with voice to voice messages")
+            else:
+                logger.warning("⚠️  Text-to-speech not fully configured - check AZURE_TTS_MODEL and AZURE_TTS_VOICE")
+            
+            self.client.add_event_handler(self.handle_new_message, events.NewMessage(incoming=True))
+            await self.client.run_until_disconnected()
+        finally:
+            # Always release the DB worker thread, or a failed login leaves the process hanging
+            await self.ai.close()
+            await self.db.close()
+    
+    async def get_message_text(self, event) -> str:
+        """Get the text of a message, transcribing voice messages"""
+        if event.message.voice:
+            return await self.handle_voice_message(event)
+        elif event.message.message:
+            return event.message.message
+        else:
+            return "[Media/Sticker]"
+    
+    async def download_media_to_memory(self, message, name: str) -> io.BytesIO:
+        """Download a message's document into memory, fetching its parts in parallel
         
-        logging.info(f"🤖 Enhanced Auto-responder started for {me.first_name}")
-        logging.info(f"📦 Products loaded: {len(self.ai.product_catalog.products)}")
-        logging.info("🚀 Bot ready - AI-powered dynamic responses!")
+        Each part is one maximum-size (512 KB) request, so typical voice notes
+        arrive in a single round trip and longer media is fetched concurrently.
+        """
+        document = message.document
+        part_count = max(1, -(-document.size // self.DOWNLOAD_PART_SIZE))
         
-        if self.ai.ffmpeg_available:
-            logging.info("🎤 Speech-to-text enabled for voice messages")
-        else:
-            logging.warning("⚠️  Speech-to-text limited - install ffmpeg for full support")
+        async def download_part(index: int) -> bytes:
+            async with self._download_semaphore:
+                download = self.client.iter_download(
+                    document,
+                    offset=index * self.DOWNLOAD_PART_SIZE,
+                    request_size=self.DOWNLOAD_PART_SIZE,
+                    limit=1,
+                    file_size=document.size
+                )
+                try:
+                    async for chunk in download:
+                        return chunk
+                finally:
+                    # Telethon only closes the iterator itself on a short read; a
+                    # full part would otherwise never return a borrowed DC sender
+                    await download.close()
+            return b""
         
-        # Check if TTS is properly configured
-        if self.config.AZURE_TTS_MODEL and self.config.AZURE_TTS_VOICE:
-            logging.info("🔊 Text-to-speech enabled - will respond with voice to voice messages")
-        else:
-            logging.warning("⚠️  Text-to-speech not fully configured - check AZURE_TTS_MODEL and AZURE_TTS_VOICE")
+        parts = await asyncio.gather(*(download_part(i) for i in range(part_count)))
         
-        self.client.add_event_handler(self.handle_new_message, events.NewMessage(incoming=True))
-        await self.client.run_until_disconnected()
+        media = io.BytesIO(b"".join(parts))
+        media.name = name
+        return media
+    
+    async def stream_media(self, document) -> AsyncIterable[bytes]:
+        """Yield a document's chunks in order as they download
+        
+        A download slot is held only while chunks are being fetched, not while
+        the consumer processes them after the last one.
+        """
+        async with self._download_semaphore:
+            download = self.client.iter_download(document, request_size=self.DOWNLOAD_PART_SIZE)
+            try:
+                async for chunk in download:
+                    yield chunk
+            finally:
+                await download.close()
     
     async def handle_voice_message(self, event) -> str:
         """Handle voice messages by converting to text"""
         try:
-            # Download voice message
-            logging.info("📥 Downloading voice message...")
-            voice_file = await event.message.download_media()
+            ext = event.message.file.ext or '.ogg'
+            if ext.lower() not in AIResponder.WHISPER_FORMATS and self.ai.ffmpeg_available:
+                # Needs converting anyway, so feed the download into ffmpeg as it arrives
+                logger.info("📥 Streaming voice message into ffmpeg...")
+                chunks = self.stream_media(event.message.document)
+                try:
+                    transcribed_text = await self.ai.transcribe_converted(chunks)
+                finally:
+                    await chunks.aclose()
+                
+                logger.info("📝 Voice transcribed: %s...", transcribed_text[:100])
+                return f"[Voice message]: {transcribed_text}"
             
-            if voice_file:
+            # Download voice message into memory
+            logger.info("📥 Downloading voice message...")
+            voice_file = await self.download_media_to_memory(event.message, f"voice{ext}")
+            
+            if voice_file.getbuffer().nbytes:
                 # Transcribe audio
                 transcribed_text = await self.ai.transcribe_audio(voice_file)
                 
-                # Clean up the downloaded file
-                try:
-                    os.remove(voice_file)
-                except:
-                    pass
-                
-                logging.info(f"📝 Voice transcribed: {transcribed_text[:100]}...")
+                logger.info("📝 Voice transcribed: %s...", transcribed_text[:100])
                 return f"[Voice message]: {transcribed_text}"
             
             return "[Voice message - download failed]"
             
         except Exception as e:
-            logging.error(f"❌ Error handling voice message: {e}")
+            logger.error("❌ Error handling voice message: %s", e)
             return "[Voice message - could not process]"
     
     async def send_voice_response(self, event, response_text: str) -> bool:
         """Send a voice response using TTS"""
         try:
             # Generate speech from text
-            audio_file_path = await self.ai.tts_converter.text_to_speech(response_text)
+            audio_file_path = await self.ai.text_to_speech(response_text)
             
             if audio_file_path and os.path.exists(audio_file_path):
-                # Send the voice message using proper Telethon method
-                await event.respond(
-                    file=audio_file_path,
-                    attributes=[DocumentAttributeAudio(
-                        duration=0,  # Duration will be auto-detected
-                        voice=True   # This makes it a voice message
-                    )]
-                )
-                
-                # Clean up the temporary audio file
                 try:
-                    os.remove(audio_file_path)
-                except:
-                    pass
+                    # Send the voice message using proper Telethon method
+                    await event.respond(
+                        file=audio_file_path,
+                        attributes=[DocumentAttributeAudio(
+                            duration=0,  # Duration will be auto-detected
+                            voice=True   # This makes it a voice message
+                        )]
+                    )
+                finally:
+                    # Clean up the temporary audio file, even if sending failed
+                    try:
+                        os.remove(audio_file_path)
+                    except OSError:
+                        pass
                 
-                logging.info("🔊 Voice response sent successfully")
+                logger.info("🔊 Voice response sent successfully")
                 return True
             else:
-                logging.error("❌ Failed to generate voice response")
+                logger.error("❌ Failed to generate voice response")
                 return False
                 
         except Exception as e:
-            logging.error(f"❌ Error sending voice response: {e}")
+            logger.error("❌ Error sending voice response: %s", e)
             return False
     
+    async def send_streamed_response(self, event, user_message: str, user_name: str, 
+                                     conversation_history: List[str]) -> tuple[str, str]:
+        """Reply with the first sentence as soon as it is generated, then edit in the full text"""
+        first_sentence = asyncio.get_running_loop().create_future()
+        generation = asyncio.create_task(self.ai.generate_response(
+            event.sender_id, user_message, user_name, conversation_history, first_sentence=first_sentence
+        ))
+        
+        first_text, _ = await asyncio.gather(first_sentence, asyncio.sleep(self.config.RESPONSE_DELAY))
+        sent_message = await event.respond(first_text)
+        
+        ai_response, user_type = await generation
+        if ai_response != first_text:
+            await sent_message.edit(ai_response)
+        
+        return ai_response, user_type
+    
     async def handle_new_message(self, event):
         try:
             if not self.config.AUTO_RESPOND or event.sender_id == self.my_id:
@@ -595,72 +1333,69 @@ class TelegramAutoResponder:
             if not event.is_private and not self.config.RESPOND_TO_GROUPS:
                 return
             
-            sender = await event.get_sender()
+            # Sender lookup, history load and voice transcription don't
+            # depend on each other, so run them concurrently
+            is_voice_message = bool(event.message.voice)
+            sender, conversation_history, user_message = await asyncio.gather(
+                event.get_sender(),
+                self.db.get_user_history(event.sender_id),
+                self.get_message_text(event)
+            )
             user_name = self.get_display_name(sender)
             
-            # Handle different message types
-            is_voice_message = False
-            if event.message.voice:
-                user_message = await self.handle_voice_message(event)
-                is_voice_message = True
-            elif event.message.message:
-                user_message = event.message.message
-            else:
-                user_message = "[Media/Sticker]"
+            # Trim once here; everything downstream sends the list as-is
+            start = max(0, len(conversation_history) - self.config.PROMPT_HISTORY_LENGTH)
+            conversation_history = conversation_history[start:]
             
             chat_type = "private" if event.is_private else "group"
             
-            logging.info(f"📨 [{chat_type.upper()}] {user_name} ({event.sender_id}): {user_message}")
-            
-            conversation_history = self.db.get_user_history(event.sender_id)
+            logger.info("📨 [%s] %s (%d): %s", chat_type.upper(), user_name, event.sender_id, user_message)
             
-            # Generate AI response
-            logging.info("🤖 Generating AI response...")
-            ai_response, user_type = await self.ai.generate_response(
-                user_message, user_name, conversation_history
-            )
-            
-            await asyncio.sleep(self.config.RESPONSE_DELAY)
-            
-            # If user sent a voice message, respond with voice
-            if is_voice_message:
-                # Try to send voice response first
-                voice_sent = await self.send_voice_response(event, ai_response)
-                if not voice_sent:
-                    # Fallback to text if voice fails
-                    await event.respond(ai_response)
-                    logging.info("⚠️  Voice response failed, sent text instead")
-                else:
-                    logging.info(f"✅ [{user_type.upper()}] Voice response sent to {user_name}: {ai_response[:80]}...")
+            logger.info("🤖 Generating AI response...")
+            if not is_voice_message and self.config.STREAM_RESPONSES:
+                # Send the first sentence early and edit in the rest
+                ai_response, user_type = await self.send_streamed_response(
+                    event, user_message, user_name, conversation_history
+                )
+                logger.info("✅ [%s] Streamed response sent to %s: %s...", user_type.upper(), user_name, ai_response[:80])
             else:
-                # Send text response for text messages
-                await event.respond(ai_response)
-                logging.info(f"✅ [{user_type.upper()}] Text response sent to {user_name}: {ai_response[:80]}...")
-            
-            # Update history
-            updated_history = conversation_history[-self.config.MAX_HISTORY_LENGTH:]
-            updated_history.extend([user_message, ai_response])
+                # Generate AI response while the response delay runs
+                (ai_response, user_type), _ = await asyncio.gather(
+                    self.ai.generate_response(event.sender_id, user_message, user_name, conversation_history),
+                    asyncio.sleep(self.config.RESPONSE_DELAY)
+                )
+                
+                # If user sent a voice message, respond with voice
+                if is_voice_message:
+                    # Try to send voice response first
+                    voice_sent = await self.send_voice_response(event, ai_response)
+                    if not voice_sent:
+                        # Fallback to text if voice fails
+                        await event.respond(ai_response)
+                        logger.info("⚠️  Voice response failed, sent text instead")
+                    else:
+                        logger.info("✅ [%s] Voice response sent to %s: %s...", user_type.upper(), user_name, ai_response[:80])
+                else:
+                    # Send text response for text messages
+                    await event.respond(ai_response)
+                    logger.info("✅ [%s] Text response sent to %s: %s...", user_type.upper(), user_name, ai_response[:80])
             
             # Save to database
-            self.db.log_conversation(event.sender_id, event.chat_id, 
-                                   user_message, ai_response, chat_type, user_type)
-            
             username = getattr(sender, 'username', '') or ''
-            self.db.update_user_session(event.sender_id, user_name, username, updated_history, user_type)
+            self.db.record_turn(event.sender_id, event.chat_id, user_message, ai_response,
+                                chat_type, user_type, user_name, username)
             
         except Exception as e:
-            logging.error(f"❌ Error handling message: {e}", exc_info=True)
+            logger.error("❌ Error handling message: %s", e, exc_info=True)
     
     def get_display_name(self, user) -> str:
-        if hasattr(user, 'first_name') and user.first_name:
-            name = user.first_name
-            if hasattr(user, 'last_name') and user.last_name:
-                name += f" {user.last_name}"
-            return name
-        elif hasattr(user, 'username') and user.username:
-            return f"@{user.username}"
-        else:
-            return "User"
+        first_name = getattr(user, 'first_name', None)
+        if first_name:
+            last_name = getattr(user, 'last_name', None)
+            return f"{first_name} {last_name}" if last_name else first_name
+        
+        username = getattr(user, 'username', None)
+        return f"@{username}" if username else "User"
 
 # =================== MAIN EXECUTION ===================
 async def main():
@@ -670,25 +1405,29 @@ async def main():
         # Validate environment variables
         Config.validate()
         
-        logging.info("🚀 Starting Enhanced AI-Powered Telegram Auto-Responder...")
-        logging.info(f"📅 {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+        logger.info("🚀 Starting Enhanced AI-Powered Telegram Auto-Responder...")
+        logger.info("📅 %s", datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+        logger.info("🔁 Event loop: %s", 'uvloop' if uvloop is not None else 'asyncio')
         
         bot = TelegramAutoResponder()
         await bot.start()
         
     except ValueError as e:
-        logging.error(f"❌ Configuration error: {e}")
+        logger.error("❌ Configuration error: %s", e)
         print(f"\n❌ Configuration error: {e}")
         print("Please check your .env file and ensure all required variables are set.")
     except KeyboardInterrupt:
-        logging.info("⏹️  Bot stopped by user")
+        logger.info("⏹️  Bot stopped by user")
     except Exception as e:
-        logging.error(f"💥 Bot crashed: {e}", exc_info=True)
+        logger.error("💥 Bot crashed: %s", e, exc_info=True)
     finally:
-        logging.info("👋 Bot shutdown complete")
+        logger.info("👋 Bot shutdown complete")
 
 if __name__ == "__main__":
     try:
-        asyncio.run(main())
+        if uvloop is not None:
+            uvloop.run(main())
+        else:
+            asyncio.run(main())
     except KeyboardInterrupt:
         print("\n👋 Bot stopped")
\ No newline at end of file